@@ -1,14 +1,29 @@
+import atexit
+import json
+import logging
 import os
+import queue
+import shelve
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, partial
 from pathlib import PurePosixPath
-from typing import Dict, Iterable, List, NamedTuple, Optional, Union
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, \
+    Tuple, TypeVar, Union
+from urllib.parse import quote
 
+import requests
 from atlassian import Bitbucket
 from gitlab import DEVELOPER_ACCESS, Gitlab, GitlabError, GitlabHttpError, \
-    OWNER_ACCESS, REPORTER_ACCESS
+    GitlabParsingError, OWNER_ACCESS, REPORTER_ACCESS
 from gitlab.v4.objects import Group, Project, User
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3 import Retry
 
 # -----------------------------------------------------------------------------
 # please provide credentials through these environment variables
@@ -24,6 +39,9 @@ BITBUCKET_TOKEN = os.getenv('BITBUCKET_TOKEN')
 # please change these config options according to your needs
 # -----------------------------------------------------------------------------
 
+# write the messages about each imported repo to this file instead of the console, which then
+# only shows the progress and warnings (optional, set to '' to print everything to the console)
+log_file = ''
 # how to handle duplicates. one of 'error' (raise an exception), 'ignore' (don't import),
 # 'rename' (import under a different name)
 on_duplicate = 'ignore'
@@ -32,8 +50,35 @@ group_prefix = ''
 # the max. number of imports to run at the same time
 # (one import per CPU core on your GitLab server should work fine)
 parallel_imports = 4
-# don't import projects with these Bitbucket project keys (optional)
-project_blacklist = []
+# the max. number of seconds to wait for a response from Bitbucket or GitLab
+request_timeout = 75
+# the min. and max. number of seconds to wait between two status checks of the running imports.
+# in between, we wait a tenth of the time that the latest import has been running, so that
+# waiting for the next check only adds a small fraction to the duration of an import
+min_poll_interval = 1.0
+max_poll_interval = 10.0
+# the max. number of concurrent API requests while collecting metadata from Bitbucket
+# and copying permissions to GitLab
+parallel_requests = 16
+# don't import projects with these Bitbucket project keys, e.g. frozenset({'KEY1', 'KEY2'})
+# (optional)
+project_blacklist = frozenset()
+# request all GitLab users at once before copying permissions, instead of looking up each
+# Bitbucket user individually (you may want to disable this if you have a lot more users in
+# GitLab than in Bitbucket)
+prefetch_gitlab_users = True
+# remember which GitLab user belongs to which Bitbucket user in this file, so that
+# re-runs don't have to look them up again (only when users are not prefetched, optional,
+# set to '' to disable)
+user_cache_file = '.user_cache.db'
+# remember all Bitbucket repos that were imported successfully in this file and don't import them
+# again in later runs, not even when they were deleted in GitLab. failed or canceled imports are
+# not remembered (optional, set to '' to disable)
+import_log_file = ''
+# remember the repo slugs of each Bitbucket project in this file and reuse them in later runs.
+# note that repos which were created in Bitbucket after the file was written are not seen
+# until you delete it (optional, set to '' to disable)
+repo_cache_file = ''
 # map bitbucket permissions to these gitlab access levels
 permission_map = {
     'PROJECT_READ': REPORTER_ACCESS,
@@ -46,6 +91,24 @@ permission_map = {
 
 # -----------------------------------------------------------------------------
 
+log = logging.getLogger('bitbucket-to-gitlab')
+_thread_local = threading.local()
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_required_env = {
+    'bitbucket': ('BITBUCKET_URL', 'BITBUCKET_USER', 'BITBUCKET_TOKEN'),
+    'gitlab': ('GITLAB_URL', 'GITLAB_TOKEN'),
+}
+# the status codes that urllib3 retries for each service. python-gitlab already retries
+# 429 (Too Many Requests) itself, so a second layer of retries would multiply the requests
+_retry_statuses = {
+    'bitbucket': (429, 500, 502, 503, 504),
+    'gitlab': (500, 502, 503, 504),
+}
+_graphql_supported = True
+T = TypeVar('T')
+R = TypeVar('R')
+
 
 class ProjectMapping(NamedTuple):
     bb_project: str
@@ -57,47 +120,81 @@ class ProjectMapping(NamedTuple):
     gl_project: str
     """the new project slug in GitLab (under which URL the project will be accessible)"""
 
+    @property
+    def bitbucket_path(self):
+        return f"{self.bb_project}/{self.bb_repo}"
+
     @property
     def gitlab_path(self):
         return f"{self.gl_group}/{self.gl_project}"
 
 
+class GraphQLError(Exception):
+    """the errors that GitLab returned for a GraphQL query"""
+
+    def __init__(self, errors: List[Dict]):
+        super().__init__("; ".join(str(e.get('message', e)) for e in errors))
+        self.errors = errors
+
+    @property
+    def is_schema_error(self) -> bool:
+        # unknown fields or arguments mean that this GitLab version doesn't support our query.
+        # newer versions send an error code, older ones only the message
+        for error in self.errors:
+            code = (error.get('extensions') or {}).get('code')
+            message = str(error.get('message', ''))
+            if code in ('undefinedField', 'argumentNotAccepted', 'undefinedType') \
+                    or "doesn't exist on type" in message or "doesn't accept argument" in message:
+                return True
+        return False
+
+
 class BitbucketRepoGenerator(ABC):
 
     def __init__(self):
-        # check params
-        check_env('BITBUCKET_URL')
-        check_env('BITBUCKET_USER')
-        check_env('BITBUCKET_TOKEN')
         # connect to bitbucket
-        self.bitbucket = Bitbucket(
-            url=BITBUCKET_URL, username=BITBUCKET_USER, password=BITBUCKET_TOKEN)
-        self.group_count: Optional[int] = None
+        self.bitbucket = make_bitbucket()
 
     @abstractmethod
     def yield_repos(self) -> Iterable[ProjectMapping]:
         pass
 
+    def fetch_repo_lists(self, bb_project_slugs: Iterable[str]) -> Iterator[Tuple[str, List[str]]]:
+        # the repo lists are independent of each other, so we request them concurrently
+        # and return them in the same order as the project slugs
+        return map_concurrently(self.get_repo_slugs, bb_project_slugs)
+
+    def get_repo_slugs(self, bb_project_slug: str) -> List[str]:
+        # this is called from worker threads, which use their own client on the shared session.
+        # we only need the slugs, so we don't keep the full repo objects
+        bitbucket, _ = _get_thread_clients()
+        return [bb_repo['slug'] for bb_repo in bitbucket.repo_list(bb_project_slug)]
+
 
 class BitbucketMainRepoGenerator(BitbucketRepoGenerator):
 
     def __init__(self):
         super().__init__()
         print(f"requesting all repos from {BITBUCKET_URL} that are visible to {BITBUCKET_USER}")
-        self.projects = list(self.bitbucket.project_list())
-        self.group_count = len(self.projects)
+        # the project list is paginated, we process each page as soon as it arrives
+        self.projects = self.bitbucket.project_list()
+        # the repo slugs of each project are needed again when we copy permissions
+        self.repo_cache = load_repo_cache()
+
+    def get_repo_slugs(self, bb_project_slug: str) -> List[str]:
+        if bb_project_slug not in self.repo_cache:
+            self.repo_cache[bb_project_slug] = super().get_repo_slugs(bb_project_slug)
+        return self.repo_cache[bb_project_slug]
 
     def yield_repos(self):
         # iterate over all projects (groups) and repos (projects) in bitbucket
         counter = 0
-        for bb_project in tqdm(self.projects, unit='project groups'):
-            bb_project_slug = bb_project['key']
-            if bb_project_slug in project_blacklist:
-                continue
+        bb_project_slugs = (p['key'] for p in self.projects if p['key'] not in project_blacklist)
+        repo_lists = self.fetch_repo_lists(bb_project_slugs)
+        for bb_project_slug, bb_repo_slugs in tqdm(repo_lists, unit='project groups'):
             gl_group = get_gitlab_group(bb_project_slug)
             # list all repos in this group
-            for bb_repo in self.bitbucket.repo_list(bb_project_slug):
-                bb_repo_slug = bb_repo['slug']
+            for bb_repo_slug in bb_repo_slugs:
                 project = ProjectMapping(
                     bb_project=bb_project_slug,
                     bb_repo=bb_repo_slug,
@@ -114,22 +211,17 @@ class BitbucketPersonalRepoGenerator(BitbucketRepoGenerator):
     def __init__(self):
         super().__init__()
         print(f"requesting all users from {BITBUCKET_URL} that are visible to {BITBUCKET_USER}")
-        self.users = list(self.bitbucket.get_users_info(limit=None))
-        self.group_count = len(self.users)
+        self.users = self.bitbucket.get_users_info(limit=None)
 
     def yield_repos(self) -> Iterable[ProjectMapping]:
         counter = 0
-        for bb_user in tqdm(self.users, unit='users'):
-            bb_user_slug = bb_user['slug']
-            if bb_user_slug in project_blacklist:
-                continue
-            bb_user_path = f'~{bb_user_slug}'
-            # list all repos in this group
-            bb_repos = list(self.bitbucket.repo_list(bb_user_path))
-            if not bb_repos:
+        bb_user_paths = (f"~{u['slug']}" for u in self.users if u['slug'] not in project_blacklist)
+        repo_lists = self.fetch_repo_lists(bb_user_paths)
+        for bb_user_path, bb_repo_slugs in tqdm(repo_lists, unit='users'):
+            bb_user_slug = bb_user_path[1:]
+            if not bb_repo_slugs:
                 tqdm.write(f"skipping {bb_user_slug}, no personal projects found")
-            for bb_repo in bb_repos:
-                bb_repo_slug = bb_repo['slug']
+            for bb_repo_slug in bb_repo_slugs:
                 project = ProjectMapping(
                     bb_project=bb_user_path,
                     bb_repo=bb_repo_slug,
@@ -141,108 +233,313 @@ class BitbucketPersonalRepoGenerator(BitbucketRepoGenerator):
         tqdm.write(f"{counter} Bitbucket repos have been returned")
 
 
+class TqdmLoggingHandler(logging.Handler):
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
 def check_env(env: str):
     if not os.getenv(env):
         raise ValueError(f"please provide {env} as environment variable")
 
 
-def get_gitlab_group(bitbucket_project):
+def map_concurrently(func: Callable[[T], R], items: Iterable[T]) -> Iterator[Tuple[T, R]]:
+    # like ThreadPoolExecutor.map, but the items are consumed lazily, so that we can already
+    # work on the first items while the rest is still being requested (e.g. from a paginated
+    # API). returns (item, result) pairs in the original order of the items
+    with ThreadPoolExecutor(max_workers=parallel_requests) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= 2 * parallel_requests:
+                done_item, future = pending.popleft()
+                yield done_item, future.result()
+        for done_item, future in pending:
+            yield done_item, future.result()
+
+
+def prefetch(items: Iterable[T], size: int) -> Iterator[T]:
+    # iterate over the items in a background thread, so that producing the items overlaps with
+    # the work of the consumer. at most `size` items are buffered. exceptions that are raised
+    # by the producer are re-raised in the consumer
+    buffer = queue.Queue(maxsize=size)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put((item, None))
+            buffer.put((done, None))
+        except BaseException as e:
+            buffer.put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = buffer.get()
+        if item is done:
+            if error:
+                raise error
+            return
+        yield item
+
+
+@lru_cache(maxsize=None)
+def get_gitlab_group(bitbucket_project: str) -> str:
     if group_prefix:
         return str(PurePosixPath(group_prefix.strip('/')) / bitbucket_project)
     else:
         return bitbucket_project
 
 
-def copy_permissions(dry_run=False):
+def make_bitbucket() -> Bitbucket:
+    return Bitbucket(url=BITBUCKET_URL, username=BITBUCKET_USER, password=BITBUCKET_TOKEN,
+                     timeout=request_timeout, session=get_session('bitbucket'))
+
+
+def make_gitlab() -> Gitlab:
+    return Gitlab(GITLAB_URL, private_token=GITLAB_TOKEN, timeout=request_timeout,
+                  session=get_session('gitlab'))
+
+
+def get_session(service: str) -> requests.Session:
+    # all clients of the same service share one session for the whole run, so that open
+    # connections (and their TLS handshakes) are reused. Bitbucket and GitLab never share a
+    # session, because the Bitbucket client stores its credentials in the session
+    with _sessions_lock:
+        if service not in _sessions:
+            # this is the first connection to this service, so we validate its settings once
+            for env in _required_env[service]:
+                check_env(env)
+            session = requests.Session()
+            mount_http_adapter(session, _retry_statuses[service])
+            _sessions[service] = session
+        return _sessions[service]
+
+
+def mount_http_adapter(session: requests.Session, retry_statuses: Tuple[int, ...]):
+    # the default connection pool only keeps 10 connections per host alive, which is not enough
+    # if parallel_requests or parallel_imports are raised. we also retry requests that fail
+    # with one of `retry_statuses` on the same connection (the first retry is immediate, then we
+    # wait 2, 4, 8 and 16 seconds), honoring Retry-After when the server is throttling us
+    # (POST requests, i.e. imports, are never retried by urllib3)
+    retry = Retry(total=5, backoff_factor=1.0, status_forcelist=retry_statuses,
+                  respect_retry_after_header=True, raise_on_status=False)
+    pool_size = max(parallel_requests, parallel_imports)
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def copy_permissions(dry_run=False, repo_cache: Optional[Dict[str, List[str]]] = None):
     # prepare bitbucket & gitlab
-    bitbucket = Bitbucket(url=BITBUCKET_URL, username=BITBUCKET_USER, password=BITBUCKET_TOKEN)
-    gitlab = Gitlab(GITLAB_URL, private_token=GITLAB_TOKEN)
+    bitbucket = make_bitbucket()
+    gitlab = make_gitlab()
     user_map = {}
+    user_map_lock = threading.Lock()
+    user_cache = None
     gitlab.auth()
     current_user = gitlab.user
+    if prefetch_gitlab_users:
+        print(f"requesting all users from {GITLAB_URL}")
+        for gl_user in gitlab.users.list(as_list=False, per_page=100):
+            user_map[gl_user.username.lower()] = gl_user
+    elif user_cache_file:
+        user_cache = shelve.open(user_cache_file)
+
+    if repo_cache is None:
+        repo_cache = load_repo_cache()
+
+    # go through all bitbucket projects, each project is handled by one worker thread
+    try:
+        process_project = partial(
+            _copy_project_permissions, repo_cache=repo_cache, user_map=user_map,
+            user_map_lock=user_map_lock, user_cache=user_cache, current_user=current_user,
+            dry_run=dry_run)
+        for _ in tqdm(map_concurrently(process_project, bitbucket.project_list()), unit='project'):
+            pass
+    finally:
+        if user_cache is not None:
+            user_cache.close()
 
-    # go through all bitbucket projects
-    project_list = list(bitbucket.project_list())
-    for bb_project in tqdm(project_list, unit='project'):
-        bb_project_slug = bb_project['key']
-        tqdm.write(f"----- {bb_project_slug} -----")
+    print("finished fixing permissions")
 
-        # skip when blacklisted
-        if bb_project_slug in project_blacklist:
-            tqdm.write(f"skipping blacklisted project {bb_project_slug}")
-            continue
 
-        # skip when there are no repos
-        bb_repo_list = list(bitbucket.repo_list(bb_project_slug))
-        if not bb_repo_list:
-            tqdm.write(f"skipping empty project {bb_project_slug}")
-            continue
+def _copy_project_permissions(bb_project: Dict, repo_cache: Dict[str, List[str]],
+                              user_map: Dict[str, User],
+                              user_map_lock: threading.Lock, user_cache: Optional[shelve.Shelf],
+                              current_user: User, dry_run=False):
+    # projects are processed in parallel, so we collect the output of each project and write it
+    # in one piece when we're done, to keep the messages of each project together
+    bb_project_slug = bb_project['key']
+    output = [f"----- {bb_project_slug} -----"]
+    try:
+        _copy_project_permissions_to(bb_project_slug, repo_cache, user_map, user_map_lock,
+                                     user_cache, current_user, output, dry_run)
+    finally:
+        tqdm.write("\n".join(output))
+
+
+def _copy_project_permissions_to(bb_project_slug: str, repo_cache: Dict[str, List[str]],
+                                 user_map: Dict[str, User], user_map_lock: threading.Lock,
+                                 user_cache: Optional[shelve.Shelf], current_user: User,
+                                 output: List[str], dry_run=False):
+    bitbucket, gitlab = _get_thread_clients()
+
+    # skip when blacklisted
+    if bb_project_slug in project_blacklist:
+        output.append(f"skipping blacklisted project {bb_project_slug}")
+        return
 
-        # copy group permissions
-        bb_project_users = list(bitbucket.project_users(bb_project_slug))
-        gl_group_path = get_gitlab_group(bb_project_slug)
-        gl_group = gitlab.groups.get(gl_group_path)
-        copy_permissions_for(
-            gitlab, user_map, bb_project_users, gl_group, current_user, dry_run=dry_run)
-
-        # copy project permissions
-        for bb_repo in bb_repo_list:
-            repo_slug = bb_repo['slug']
-            bb_repo_users = list(bitbucket.repo_users(bb_project_slug, repo_slug))
-            gl_project = gitlab.projects.get(f'{gl_group_path}/{repo_slug}')
-            copy_permissions_for(
-                gitlab, user_map, bb_repo_users, gl_project, current_user, dry_run=dry_run)
+    # skip when there are no repos
+    bb_repo_slugs = repo_cache.get(bb_project_slug)
+    if bb_repo_slugs is None:
+        bb_repo_slugs = [bb_repo['slug'] for bb_repo in bitbucket.repo_list(bb_project_slug)]
+        repo_cache[bb_project_slug] = bb_repo_slugs
+    if not bb_repo_slugs:
+        output.append(f"skipping empty project {bb_project_slug}")
+        return
 
-    print("finished fixing permissions")
+    # copy group permissions
+    bb_project_users = list(bitbucket.project_users(bb_project_slug))
+    gl_group_path = get_gitlab_group(bb_project_slug)
+    gl_group = gitlab.groups.get(gl_group_path)
+    copy_permissions_for(gitlab, user_map, bb_project_users, gl_group, current_user,
+                         user_map_lock=user_map_lock, user_cache=user_cache, output=output,
+                         dry_run=dry_run)
+
+    # copy project permissions. we list all projects of the group at once and build full
+    # project objects from the listing instead of requesting each project individually.
+    # projects that other namespaces share with the group are excluded, and we match by full
+    # path, so that we never touch a project outside of this group
+    gl_projects = {p.path_with_namespace: Project(gitlab.projects, p.attributes)
+                   for p in gl_group.projects.list(as_list=False, per_page=100, with_shared=False)}
+    for repo_slug in bb_repo_slugs:
+        bb_repo_users = list(bitbucket.repo_users(bb_project_slug, repo_slug))
+        gl_project_path = f'{gl_group_path}/{repo_slug}'
+        gl_project = gl_projects.get(gl_project_path) or gitlab.projects.get(gl_project_path)
+        copy_permissions_for(gitlab, user_map, bb_repo_users, gl_project, current_user,
+                             user_map_lock=user_map_lock, user_cache=user_cache, output=output,
+                             dry_run=dry_run)
+
+
+def _get_thread_clients() -> Tuple[Bitbucket, Gitlab]:
+    # each worker thread gets its own pair of clients, the underlying sessions are shared
+    if not hasattr(_thread_local, 'clients'):
+        _thread_local.clients = (make_bitbucket(), make_gitlab())
+    return _thread_local.clients
 
 
 def copy_permissions_for(gitlab: Gitlab, user_map: Dict[str, User], bb_users: List[Dict],
-                         gl_entity: Union[Group, Project], current_user: User, dry_run=False):
+                         gl_entity: Union[Group, Project], current_user: User,
+                         user_map_lock: Optional[threading.Lock] = None,
+                         user_cache: Optional[shelve.Shelf] = None,
+                         output: Optional[List[str]] = None, dry_run=False):
+    # messages are written right away, unless the caller collects them in `output`
+    write = tqdm.write if output is None else output.append
+    # attribute access on gitlab objects is resolved dynamically, so we only do it once
+    entity_path = gl_entity.path
+    entity_name = f"{type(gl_entity).__name__} {entity_path}"
+    members = gl_entity.members
+
     # break early if there are no users
-    entity_type = type(gl_entity).__name__
     if not bb_users:
-        tqdm.write(f"no permissions to copy for {entity_type} {gl_entity.path}")
+        write(f"no permissions to copy for {entity_name}")
         return
 
     # try to map permissions for all users
     users_granted = {}
+    user_map_lock = user_map_lock or nullcontext()
     for bb_user in bb_users:
         bb_user_name = bb_user['user']['slug']
         bb_user_access = bb_user['permission']
-        if bb_user_name not in user_map:
-            response = gitlab.users.list(username=bb_user_name)
-            user_map[bb_user_name] = response[0] if response else None
-        gl_user = user_map[bb_user_name]
-        gl_user_access = permission_map[bb_user_access]
+        # GitLab usernames are case-insensitive, so the user map is keyed by lower-case names
+        user_key = bb_user_name.lower()
+        with user_map_lock:
+            # when all users were prefetched, there is nothing left to look up
+            if user_key not in user_map and not prefetch_gitlab_users:
+                user_map[user_key] = get_gitlab_user(gitlab, bb_user_name, user_cache)
+            gl_user = user_map.get(user_key)
+        gl_user_access = permission_map.get(bb_user_access)
+        if gl_user_access is None:
+            write(f"unknown permission {bb_user_access} for {bb_user_name} in {entity_name}, "
+                  f"skipping (please add it to permission_map)")
+            continue
         if gl_user:
-            users_granted[gl_user.username] = gl_user_access
-            tqdm.write(f"adding {gl_user.username} to {entity_type} {gl_entity.path} as {bb_user_access}")
+            gl_user_id, gl_user_name = gl_user.id, gl_user.username
+            users_granted[gl_user_name] = gl_user_access
+            write(f"adding {gl_user_name} to {entity_name} as {bb_user_access}")
             if not dry_run:
                 try:
-                    gl_entity.members.create({'user_id': gl_user.id, 'access_level': gl_user_access})
+                    members.create({'user_id': gl_user_id, 'access_level': gl_user_access})
                 except GitlabError as e:
                     try:
-                        gl_entity.members.create({'user_id': gl_user.id, 'access_level': gl_user_access - 10})
+                        members.create({'user_id': gl_user_id, 'access_level': gl_user_access - 10})
                     except GitlabError as e:
                         if "already exists" in str(e):
-                            tqdm.write(f"user {gl_user.username} already exists in {entity_type} {gl_entity.path}")
+                            write(f"user {gl_user_name} already exists in {entity_name}")
                         elif "inherited membership from group" in str(e):
-                            tqdm.write(f"ignoring lower access to {entity_type} {gl_entity.path} for {gl_user.username}")
+                            write(f"ignoring lower access to {entity_name} for {gl_user_name}")
                         else:
-                            tqdm.write(f"failed to add {gl_user.username} to {entity_type} {gl_entity.path}: {e}")
+                            write(f"failed to add {gl_user_name} to {entity_name}: {e}")
 
     # remove the current user, if someone else was added as admin
     admin_added = any(level >= 50 for level in users_granted.values())
     if admin_added:
-        tqdm.write(f"deleting {current_user.username} from {entity_type} {gl_entity.path}")
+        write(f"deleting {current_user.username} from {entity_name}")
         if not dry_run:
             try:
-                gl_entity.members.delete(current_user.id)
+                members.delete(current_user.id)
             except GitlabError as e:
                 if "404" not in str(e):
-                    tqdm.write(f"failed to delete {current_user.username} from {entity_type} {gl_entity.path}: {e}")
+                    write(f"failed to delete {current_user.username} from {entity_name}: {e}")
     else:
-        tqdm.write(f"no new owner was added to {gl_entity.path}, keeping {current_user.username} as owner")
+        write(f"no new owner was added to {entity_name}, keeping {current_user.username} as owner")
+
+
+def load_repo_cache() -> Dict[str, List[str]]:
+    # restore the repo cache from a previous run. the cache is written back when the script
+    # exits, so that it also contains everything we've seen in a run that failed halfway
+    repo_cache = {}
+    if repo_cache_file:
+        if os.path.exists(repo_cache_file):
+            try:
+                with open(repo_cache_file, 'r', encoding='utf-8') as fp:
+                    repo_cache = json.load(fp)
+                if not isinstance(repo_cache, dict):
+                    raise ValueError(f"expected an object, got {type(repo_cache).__name__}")
+            except (OSError, ValueError) as e:
+                # it's just a cache, so we start over instead of failing
+                print(f"ignoring unreadable repo cache {repo_cache_file}: {e}")
+                repo_cache = {}
+        atexit.register(save_repo_cache, repo_cache)
+    return repo_cache
+
+
+def save_repo_cache(repo_cache: Dict[str, List[str]]):
+    # background threads may still be adding repos while the script exits, so we write a
+    # snapshot to a temporary file first and replace the cache only when it is complete
+    snapshot = dict(repo_cache)
+    tmp_file = f"{repo_cache_file}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+        json.dump(snapshot, fp)
+    os.replace(tmp_file, repo_cache_file)
+
+
+def get_gitlab_user(gitlab: Gitlab, username: str,
+                    user_cache: Optional[shelve.Shelf] = None) -> Optional[User]:
+    # users that were found in a previous run can be restored from the cache. we only store
+    # the attributes that we need (id and username), without requesting the full user again
+    if user_cache is not None and username in user_cache:
+        return User(gitlab.users, user_cache[username])
+    response = gitlab.users.list(username=username)
+    gl_user = response[0] if response else None
+    if user_cache is not None and gl_user:
+        user_cache[username] = {'id': gl_user.id, 'username': gl_user.username}
+    return gl_user
 
 
 def import_main_projects():
@@ -257,64 +554,220 @@ def import_personal_projects():
 
 def import_projects(repo_generator: BitbucketRepoGenerator):
     # import all projects
-    print(f"importing {repo_generator.group_count} project groups in GitLab at {GITLAB_URL}")
-    gitlab = Gitlab(GITLAB_URL, private_token=GITLAB_TOKEN)
-    projects_iter = repo_generator.yield_repos()
+    setup_logging()
+    print(f"importing all project groups in GitLab at {GITLAB_URL}")
+    gitlab = make_gitlab()
+    imported_repos = load_import_log()
+    # imports are running asynchronously and in parallel. a background thread triggers the import
+    # of each repo as soon as Bitbucket returns it and one of the slots is free. meanwhile, we
+    # frequently check the status of the running imports here and free their slots when they're done
+    slots = threading.Semaphore(parallel_imports)
+    triggered = queue.Queue()
+    threading.Thread(target=_trigger_imports, daemon=True, args=(
+        repo_generator.yield_repos(), imported_repos, slots, triggered)).start()
     processing: List[Project] = []
+    started_at: Dict[int, float] = {}
+    # the Bitbucket repo of each job, so that we can log it when the import has finished
+    job_projects: Dict[int, ProjectMapping] = {}
     counter = 0
-    # imports are running asynchronously and in parallel. we frequently check the status
-    # of each import and queue new imports until we run out of jobs to process
-    while True:
-        if len(processing) < parallel_imports:
-            try:
-                project: ProjectMapping = next(projects_iter)
-                tqdm.write(f"importing {project.gitlab_path}")
-                job = trigger_import(gitlab, project)
-                if job:
-                    processing.append(job)
-                    counter += 1
-            except StopIteration:
-                tqdm.write(f"all imports were triggered, waiting for running jobs to finish")
-                break
+    triggering = True
+    next_check = float('inf')
+    while triggering or processing:
+        # wait for newly triggered imports, but only until the next status check is due
+        timeout = max(next_check - time.monotonic(), 0) if processing else None
+        try:
+            project, job = triggered.get(timeout=timeout)
+        except queue.Empty:
+            running = check_imports(gitlab, processing, started_at, job_projects, imported_repos)
+            for _ in range(len(processing) - len(running)):
+                slots.release()
+            processing = running
+            next_check = time.monotonic() + poll_interval(processing, started_at)
+            continue
+        if project is None:
+            # the trigger thread is done, either because it ran out of repos or because it failed
+            triggering = False
+            if job is not None:
+                raise job
+            tqdm.write(f"all imports were triggered, waiting for running jobs to finish")
         else:
-            processing = check_and_sleep(gitlab, processing)
-    # almost finished, just wait for the last few jobs
-    while processing:
-        processing = check_and_sleep(gitlab, processing)
+            processing.append(job)
+            started_at[job.id] = time.monotonic()
+            job_projects[job.id] = project
+            next_check = min(next_check, started_at[job.id] + min_poll_interval)
+            counter += 1
     print(f"{counter} projects were imported in GitLab")
 
 
-def check_and_sleep(gitlab: Gitlab, processing: List[Project], sleep_time=1.0) -> List[Project]:
+def _trigger_imports(repos: Iterable[ProjectMapping], imported_repos: Set[str],
+                     slots: threading.Semaphore, triggered: queue.Queue):
+    # this runs in a background thread. each repo is handed to a worker as soon as it arrives and
+    # a slot is free, the workers put (project, job) into `triggered` for each import they start.
+    # at the end, we put (None, None) or (None, error) if something went wrong
+    try:
+        # keep collecting repos from Bitbucket while we wait for free slots
+        with ThreadPoolExecutor(max_workers=parallel_imports) as executor:
+            for project in prefetch(repos, parallel_imports * 4):
+                slots.acquire()
+                executor.submit(_start_import, project, imported_repos, slots, triggered)
+        triggered.put((None, None))
+    except BaseException as e:
+        triggered.put((None, e))
+
+
+def _start_import(project: ProjectMapping, imported_repos: Set[str],
+                  slots: threading.Semaphore, triggered: queue.Queue):
+    # this is called from worker threads, which use their own client on the shared session.
+    # when no import was started, the slot is freed right away
+    job = None
+    try:
+        if project.bitbucket_path in imported_repos:
+            log.info(f"repo {project.bitbucket_path} was imported in a previous run, skipping")
+        else:
+            _, gitlab = _get_thread_clients()
+            log.info(f"importing {project.gitlab_path}")
+            job = trigger_import(gitlab, project)
+    except BaseException as e:
+        triggered.put((None, e))
+    if job:
+        triggered.put((project, job))
+    else:
+        slots.release()
+
+
+def setup_logging():
+    # messages are written through tqdm, so that they don't break the progress bar. if there is
+    # a log file, everything goes there and the console only receives warnings
+    if log.handlers:
+        return
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    console = TqdmLoggingHandler()
+    log.addHandler(console)
+    if log_file:
+        console.setLevel(logging.WARNING)
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        log.addHandler(file_handler)
+
+
+def load_import_log() -> Set[str]:
+    # the import log has one line for each Bitbucket repo that was imported ("project/repo")
+    if import_log_file and os.path.exists(import_log_file):
+        with open(import_log_file, 'r', encoding='utf-8') as fp:
+            return {line.strip() for line in fp if line.strip()}
+    return set()
+
+
+def log_import(imported_repos: Set[str], project: ProjectMapping):
+    # we write every import right away, so that the log is complete even if the script crashes
+    imported_repos.add(project.bitbucket_path)
+    if import_log_file:
+        with open(import_log_file, 'a', encoding='utf-8') as fp:
+            fp.write(f"{project.bitbucket_path}\n")
+
+
+def poll_interval(processing: List[Project], started_at: Dict[int, float]) -> float:
+    # one request checks all running imports, so we always check all of them. the wait depends
+    # on the latest import (see min_poll_interval), because that one is most likely to finish
+    # soon compared to its runtime
+    if not processing:
+        return float('inf')
+    latest_start = max(started_at[job.id] for job in processing)
+    delay = (time.monotonic() - latest_start) / 10
+    return min(max(delay, min_poll_interval), max_poll_interval)
+
+
+def check_imports(gitlab: Gitlab, processing: List[Project], started_at: Dict[int, float],
+                  job_projects: Dict[int, ProjectMapping],
+                  imported_repos: Set[str]) -> List[Project]:
+    # returns the imports that are still queued or running
+    statuses = get_import_statuses(gitlab, processing)
     updated = []
     for job in processing:
-        status = gitlab.projects.get(job.id)
-        if status.import_status == 'started':
-            updated.append(status)
+        path, import_status = statuses[job.id]
+        if import_status in ('scheduled', 'started'):
+            updated.append(job)
         else:
-            if status.import_status == 'finished':
-                tqdm.write(f"import of {status.path_with_namespace} finished successfully")
+            del started_at[job.id]
+            project = job_projects.pop(job.id)
+            if import_status == 'finished':
+                log.info(f"import of {path} finished successfully")
+                # only successful imports are skipped in later runs
+                log_import(imported_repos, project)
             else:
-                tqdm.write(f"warning: import of {status.path_with_namespace} finished "
-                           f"with status {status.import_status}")
-    if len(updated) >= parallel_imports:
-        time.sleep(sleep_time)
+                log.warning(f"import of {path} finished with status {import_status}")
     return updated
 
 
+def get_import_statuses(gitlab: Gitlab, jobs: List[Project]) -> Dict[int, Tuple[str, str]]:
+    # get path and import status of all jobs with a single GraphQL request. if that doesn't
+    # work, fall back to requesting each project individually. if GraphQL is not supported
+    # at all (e.g. on old GitLab versions), we don't try it again
+    global _graphql_supported
+    statuses = {}
+    if _graphql_supported:
+        try:
+            statuses = _get_import_statuses_graphql(gitlab, jobs)
+        except GraphQLError as e:
+            if e.is_schema_error:
+                _graphql_supported = False
+                log.warning(f"GitLab doesn't support the GraphQL import status query, "
+                            f"using the REST API from now on: {e}")
+            else:
+                log.warning(f"failed to request the import status via GraphQL, "
+                            f"using the REST API: {e}")
+        except (AttributeError, KeyError, TypeError, ValueError, GitlabParsingError) as e:
+            log.warning(f"unexpected GraphQL response, using the REST API: {e!r}")
+        except GitlabHttpError as e:
+            if e.response_code == 404:
+                _graphql_supported = False
+            log.warning(f"failed to request the import status via GraphQL, using the REST API: {e}")
+    for job in jobs:
+        if job.id not in statuses:
+            # the import endpoint only returns a handful of fields instead of the full project
+            status = job.imports.get()
+            statuses[job.id] = (status.path_with_namespace, status.import_status)
+    return statuses
+
+
+def _get_import_statuses_graphql(gitlab: Gitlab, jobs: List[Project]) -> Dict[int, Tuple[str, str]]:
+    # GitLab returns at most 100 nodes per page, so we ask for large batches in chunks
+    query = """query($ids: [ID!], $first: Int) {
+        projects(ids: $ids, first: $first) { nodes { id fullPath importStatus } }
+    }"""
+    statuses = {}
+    for i in range(0, len(jobs), 100):
+        chunk = jobs[i:i + 100]
+        ids = [f'gid://gitlab/Project/{job.id}' for job in chunk]
+        variables = {'ids': ids, 'first': len(chunk)}
+        # http_post only parses responses with the exact content type 'application/json', but
+        # GitLab adds a charset for GraphQL, so we parse the response ourselves
+        result = gitlab.http_request(
+            'post', f'{gitlab.url}/api/graphql',
+            post_data={'query': query, 'variables': variables}).json()
+        # GitLab answers with 200 even when the query failed, the problem is in `errors`
+        if result.get('errors'):
+            raise GraphQLError(result['errors'])
+        for node in result['data']['projects']['nodes']:
+            project_id = int(node['id'].rsplit('/', 1)[-1])
+            statuses[project_id] = (node['fullPath'], node['importStatus'])
+    return statuses
+
+
 def trigger_import(gitlab: Gitlab, project: ProjectMapping) -> Optional[Project]:
     if on_duplicate == 'error':
         return _trigger_import(gitlab, project)
     elif on_duplicate in ('ignore', 'rename'):
+        # a HEAD request is much cheaper than an import that is bound to fail, because GitLab
+        # contacts Bitbucket before it validates the target path
+        if project_exists(gitlab, project.gitlab_path):
+            return _handle_duplicate(gitlab, project)
         try:
             return _trigger_import(gitlab, project)
         except GitlabHttpError as e:
             if e.response_code == 422 and "Path has already been taken" in str(e):
-                if on_duplicate == 'ignore':
-                    tqdm.write(f"repo {project.gitlab_path} already exists, skipping")
-                elif on_duplicate == 'rename':
-                    # TODO find a way to try suffixes until it works...
-                    tqdm.write(f"repo {project.gitlab_path} already exists, renaming")
-                    return _trigger_import(gitlab, project, suffix="_BB")
+                return _handle_duplicate(gitlab, project)
             else:
                 print(f"there was an unexpected error while importing {project}. {e}")
                 raise e
@@ -322,6 +775,25 @@ def trigger_import(gitlab: Gitlab, project: ProjectMapping) -> Optional[Project]
         raise ValueError(f"unexpected value {on_duplicate} for on_duplicate")
 
 
+def _handle_duplicate(gitlab: Gitlab, project: ProjectMapping) -> Optional[Project]:
+    if on_duplicate == 'ignore':
+        log.info(f"repo {project.gitlab_path} already exists, skipping")
+    elif on_duplicate == 'rename':
+        # TODO find a way to try suffixes until it works...
+        log.info(f"repo {project.gitlab_path} already exists, renaming")
+        return _trigger_import(gitlab, project, suffix="_BB")
+
+
+def project_exists(gitlab: Gitlab, path: str) -> bool:
+    try:
+        gitlab.http_request('head', f"/projects/{quote(path, safe='')}")
+        return True
+    except GitlabHttpError as e:
+        if e.response_code == 404:
+            return False
+        raise e
+
+
 def _trigger_import(gitlab: Gitlab, project: ProjectMapping, suffix: str = None) -> Project:
     # define the namespace
     gl_project_slug = project.gl_project
@@ -337,17 +809,20 @@ def _trigger_import(gitlab: Gitlab, project: ProjectMapping, suffix: str = None)
         new_name=gl_project_slug,
         target_namespace=project.gl_group,
     )
-    job = gitlab.projects.get(result['id'])
+    # the import status is polled separately, so we don't need to request the project here
+    job = gitlab.projects.get(result['id'], lazy=True)
     return job
 
 
 def main():
     # import all projects in the main namespace
     print("== importing Bitbucket projects from the main namespace ==")
-    import_main_projects()
-    # now we copy all permissions (these are not covered by the gitlab import)
+    repo_generator = BitbucketMainRepoGenerator()
+    import_projects(repo_generator)
+    # now we copy all permissions (these are not covered by the gitlab import). the repos
+    # of each project were already requested during the import, so we reuse them
     print("== copying members and permissions for all projects that were migrated ==")
-    copy_permissions()
+    copy_permissions(repo_cache=repo_generator.repo_cache)
     # import all personal projects (permissions are set correctly here)
     print("== importing Bitbucket projects from the user namespace ==")
     import_personal_projects()